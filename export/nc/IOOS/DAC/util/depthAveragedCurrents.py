@@ -0,0 +1,353 @@
+# Calculate the depth-averaged currents required by the IOOS_Glider_NetCDF
+# specification (time_uv, lat_uv, lon_uv, u, v) for an entire glider
+# deployment.
+#
+# A dive segment is the interval between the last GPS fix before the glider
+# dives and the first GPS fix after it surfaces.  While underwater, the glider
+# dead-reckons its position (m_lat, m_lon) from the last GPS fix.  The
+# difference between the first GPS fix after surfacing and the last
+# dead-reckoned position, divided by the time spent underwater (between the
+# first and last rows deeper than MIN_DIVE_DEPTH), is the depth-averaged
+# eastward (u) and northward (v) current over the segment.
+#
+# The segment center time and position are reported for every profile
+# contained in the segment.
+#
+# All segments are found and calculated in a single vectorized pass over the
+# deployment time series.  Calculated segments are stored in a cache dictionary
+# keyed by the (start, end) GPS fix timestamps so that subsequent runs on a
+# growing deployment only calculate currents for new dives.  Segments for which
+# no current could be calculated (ie: no dead-reckoned position recorded after
+# the end of the dive in decimated real-time data) are not cached and are
+# recalculated on subsequent runs.  The cache may be written to/read from disk
+# using saveCache and loadCache.
+#
+# Run this file to check the calculation against a synthetic deployment:
+#   python depthAveragedCurrents.py
+#
+# All input arrays are row-aligned and:
+#   ts: timestamps (seconds since 1970-01-01T00:00:00Z)
+#   depth: depth (meters)
+#   gpsLat, gpsLon: GPS fixes (decimal degrees), NaN where no fix is available
+#       (ie: drv_m_gps_lat, drv_m_gps_lon from util/processGps.m)
+#   drLat, drLon: dead-reckoned positions (decimal degrees, ie: m_lat and m_lon
+#       converted with navigation/dm2dd.m)
+#
+# See also util/addVelocities.m util/processGps.m
+
+import json
+import numpy as np
+
+# Meters per degree of arc (1 nautical mile per minute of arc, consistent with
+# navigation/gcdist.m)
+METERS_PER_DEGREE = 60 * 1852.
+# Minimum depth (meters) the glider must reach between 2 consecutive GPS fixes
+# for the interval to be considered a dive segment
+MIN_DIVE_DEPTH = 2.
+# Masterdata default lat/lon values (69696969) are at least this large
+BAD_COORDINATE = 696969
+# NetCDF variables returned by depthAveragedCurrents, in the order they are
+# stored in the cache
+UV_VARS = ('time_uv',
+    'lat_uv',
+    'lon_uv',
+    'u',
+    'v')
+
+
+def findDiveSegments(ts, depth, gpsLat, gpsLon, minDepth=MIN_DIVE_DEPTH):
+    """Return arrays of the row indices of the GPS fixes bounding each dive
+    segment: (startFix, endFix)."""
+
+    ts = np.asarray(ts, dtype=float)
+    depth = np.asarray(depth, dtype=float)
+    gpsLat, gpsLon = _validCoordinates(gpsLat, gpsLon)
+
+    fixes = np.flatnonzero(np.isfinite(ts) &
+        np.isfinite(gpsLat) &
+        np.isfinite(gpsLon))
+    if fixes.size < 2:
+        return np.array([], dtype=int), np.array([], dtype=int)
+
+    # Maximum depth reached between each pair of consecutive fixes.  Limit the
+    # array to the last fix so that the final reduction ends there.
+    z = np.where(np.isfinite(depth), depth, -np.inf)
+    maxDepth = np.maximum.reduceat(z[:fixes[-1]], fixes[:-1])
+
+    dives = maxDepth >= minDepth
+
+    return fixes[:-1][dives], fixes[1:][dives]
+
+
+def calculateSegmentCurrents(ts, depth, gpsLat, gpsLon, drLat, drLon,
+    startFix,
+    endFix,
+    minDepth=MIN_DIVE_DEPTH):
+    """Return a 2-D array, one row per segment, with columns ordered as
+    UV_VARS."""
+
+    ts = np.asarray(ts, dtype=float)
+    depth = np.asarray(depth, dtype=float)
+    gpsLat, gpsLon = _validCoordinates(gpsLat, gpsLon)
+    drLat, drLon = _validCoordinates(drLat, drLon)
+    startFix = np.asarray(startFix, dtype=int)
+    endFix = np.asarray(endFix, dtype=int)
+
+    # Row index of the most recent valid dead-reckoned position at or before
+    # each row (-1 if there is none)
+    rows = np.where(np.isfinite(drLat) & np.isfinite(drLon),
+        np.arange(ts.size),
+        -1)
+    lastDr = np.maximum.accumulate(rows)
+
+    # Time spent underwater: first to last timestamped row deeper than
+    # minDepth within each segment
+    with np.errstate(invalid='ignore'):
+        deepRows = np.flatnonzero((depth >= minDepth) & np.isfinite(ts))
+    firstDeep = np.searchsorted(deepRows, startFix, side='right')
+    lastDeep = np.searchsorted(deepRows, endFix, side='left') - 1
+    valid = firstDeep <= lastDeep
+    dt = np.full(startFix.shape, np.nan)
+    dt[valid] = ts[deepRows[lastDeep[valid]]] - ts[deepRows[firstDeep[valid]]]
+
+    # The last dead-reckoned position before the surfacing fix is reset to the
+    # GPS position.  It must have been recorded at or after the last row of the
+    # dive, otherwise (ie: decimated real-time data) any movement through the
+    # water after it would be counted as current.
+    drEnd = lastDr[endFix - 1]
+    valid[valid] = drEnd[valid] >= deepRows[lastDeep[valid]]
+    drEnd = np.where(valid, drEnd, endFix)
+
+    # Segment center
+    timeUv = (ts[startFix] + ts[endFix]) / 2
+    latUv = (gpsLat[startFix] + gpsLat[endFix]) / 2
+    lonUv = gpsLon[startFix] + _wrapLongitude(gpsLon[endFix] - gpsLon[startFix]) / 2
+    lonUv = _wrapLongitude(lonUv)
+
+    # Dead-reckoning error (meters) accumulated over the segment
+    dy = (gpsLat[endFix] - drLat[drEnd]) * METERS_PER_DEGREE
+    dx = (_wrapLongitude(gpsLon[endFix] - drLon[drEnd]) *
+        METERS_PER_DEGREE *
+        np.cos(np.deg2rad(latUv)))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u = dx / dt
+        v = dy / dt
+    u[~valid | (dt <= 0)] = np.nan
+    v[~valid | (dt <= 0)] = np.nan
+
+    return np.column_stack((timeUv, latUv, lonUv, u, v))
+
+
+def depthAveragedCurrents(ts, depth, gpsLat, gpsLon, drLat, drLon, profileTimes,
+    cache=None,
+    minDepth=MIN_DIVE_DEPTH):
+    """Return a dictionary mapping each of UV_VARS to an array containing one
+    value per profile in profileTimes.  Profiles that are not contained in a
+    complete dive segment (ie: the glider has not yet surfaced) are set to
+    NaN.  If specified, cache is a dictionary that is updated with the
+    calculated segments and is used to skip segments already calculated."""
+
+    ts = np.asarray(ts, dtype=float)
+    profileTimes = np.atleast_1d(np.asarray(profileTimes, dtype=float))
+    if cache is None:
+        cache = {}
+
+    currents = dict((var, np.full(profileTimes.shape, np.nan)) for var in UV_VARS)
+
+    startFix, endFix = findDiveSegments(ts, depth, gpsLat, gpsLon, minDepth)
+    if startFix.size == 0:
+        return currents
+
+    segStart = ts[startFix]
+    segEnd = ts[endFix]
+    keys = list(zip(segStart.tolist(), segEnd.tolist()))
+
+    # Only calculate segments that are not already in the cache
+    new = np.array([k not in cache for k in keys], dtype=bool)
+    segUv = np.full((len(keys), len(UV_VARS)), np.nan)
+    if (~new).any():
+        segUv[~new] = [cache[k] for k, n in zip(keys, new) if not n]
+    if new.any():
+        segUv[new] = calculateSegmentCurrents(ts,
+            depth,
+            gpsLat,
+            gpsLon,
+            drLat,
+            drLon,
+            startFix[new],
+            endFix[new],
+            minDepth)
+        # Only cache segments with a valid current so that failed segments
+        # are recalculated when more data is available
+        for i in np.flatnonzero(new & np.all(np.isfinite(segUv[:, 3:]), axis=1)):
+            cache[keys[i]] = tuple(segUv[i].tolist())
+
+    # Segments are in ascending chronological order and do not overlap, so
+    # the segment containing each profile is the last one starting at or before
+    # the profile time
+    seg = np.searchsorted(segStart, profileTimes, side='right') - 1
+    inSeg = (seg >= 0) & np.isfinite(profileTimes)
+    inSeg[inSeg] = profileTimes[inSeg] <= segEnd[seg[inSeg]]
+
+    for c, var in enumerate(UV_VARS):
+        currents[var][inSeg] = segUv[seg[inSeg], c]
+
+    return currents
+
+
+def loadCache(cacheFile):
+    """Load a segment cache written by saveCache."""
+
+    cache = {}
+    with open(cacheFile, 'r') as fid:
+        records = json.load(fid)
+    for record in records:
+        cache[(record[0], record[1])] = tuple(record[2:])
+
+    return cache
+
+
+def saveCache(cache, cacheFile):
+    """Write the segment cache to cacheFile as json."""
+
+    records = [list(k) + list(cache[k]) for k in sorted(cache.keys())]
+
+    with open(cacheFile, 'w') as fid:
+        json.dump(records, fid)
+
+
+def _validCoordinates(lat, lon):
+    """Return float copies of lat and lon with masterdata default values
+    replaced by NaN."""
+
+    lat = np.array(lat, dtype=float)
+    lon = np.array(lon, dtype=float)
+
+    with np.errstate(invalid='ignore'):
+        bad = (np.abs(lat) > BAD_COORDINATE) | (np.abs(lon) > BAD_COORDINATE)
+    lat[bad] = np.nan
+    lon[bad] = np.nan
+
+    return lat, lon
+
+
+def _wrapLongitude(lon):
+    """Wrap longitudes/longitude differences to [-180, 180)."""
+
+    return (np.asarray(lon) + 180.) % 360. - 180.
+
+
+def _syntheticDeployment(u, v, speed):
+    """Return (ts, depth, gpsLat, gpsLon, drLat, drLon) for 2 dives in a
+    current of u, v (m s-1) by a glider moving east at speed (m s-1) through
+    the water."""
+
+    # Rows are 10 seconds apart.  Dives at rows 10-189 and 210-389 with GPS
+    # fixes at the surface.
+    n = 400
+    ts = 1.4e9 + np.arange(n) * 10.
+    depth = np.zeros(n)
+    depth[10:190] = 20.
+    depth[210:390] = 20.
+    diving = depth >= MIN_DIVE_DEPTH
+
+    # True (x, y) and dead-reckoned (drx, dry) positions (meters).  The glider
+    # only moves while diving and dead-reckoning is reset to the true position
+    # at each GPS fix.
+    fixes = np.array([0, 5, 9, 195, 200, 205, 395, 399])
+    step = np.where(diving, 10., 0.)
+    x = np.concatenate(([0.], np.cumsum((speed + u) * step)[:-1]))
+    y = np.concatenate(([0.], np.cumsum(v * step)[:-1]))
+    drx = np.concatenate(([0.], np.cumsum(speed * step)[:-1]))
+    dry = np.zeros(n)
+    for f in fixes:
+        drx[f:] += x[f] - drx[f]
+        dry[f:] += y[f] - dry[f]
+
+    lat0 = 40.
+    lon0 = -74.
+    mPerLon = METERS_PER_DEGREE * np.cos(np.deg2rad(lat0))
+    gpsLat = np.full(n, np.nan)
+    gpsLon = np.full(n, np.nan)
+    gpsLat[fixes] = lat0 + y[fixes] / METERS_PER_DEGREE
+    gpsLon[fixes] = lon0 + x[fixes] / mPerLon
+
+    return (ts,
+        depth,
+        gpsLat,
+        gpsLon,
+        lat0 + dry / METERS_PER_DEGREE,
+        lon0 + drx / mPerLon)
+
+
+def _selfCheck():
+    """Check depthAveragedCurrents against a synthetic deployment with a known
+    current."""
+
+    import os
+    import tempfile
+
+    U = 0.1
+    V = -0.05
+    ts, depth, gpsLat, gpsLon, drLat, drLon = _syntheticDeployment(U, V, 0.3)
+    # Profiles in the first dive, the surface interval and the second dive
+    profileTimes = ts[[50, 150, 200, 300]]
+    inDive = np.array([True, True, False, True])
+
+    # 2 segments, profiles at the surface are not in a segment
+    cache = {}
+    uv = depthAveragedCurrents(ts, depth, gpsLat, gpsLon, drLat, drLon,
+        profileTimes,
+        cache=cache)
+    assert len(cache) == 2
+    assert np.all(np.isnan(uv['u'][~inDive]))
+    assert np.allclose(uv['u'][inDive], U, rtol=0.01)
+    assert np.allclose(uv['v'][inDive], V, rtol=0.01)
+    assert np.allclose(uv['time_uv'][inDive], ts[[100, 100, 300]])
+
+    # Cache round trip
+    fid, cacheFile = tempfile.mkstemp(suffix='.json')
+    os.close(fid)
+    try:
+        saveCache(cache, cacheFile)
+        loaded = loadCache(cacheFile)
+    finally:
+        os.remove(cacheFile)
+    assert loaded == cache
+    cached = depthAveragedCurrents(ts, depth, gpsLat, gpsLon, drLat, drLon,
+        profileTimes,
+        cache=loaded)
+    for var in UV_VARS:
+        assert np.array_equal(cached[var], uv[var], equal_nan=True)
+
+    # Decimated dead-reckoned positions end before the end of each dive, so
+    # no current is calculated or cached...
+    decimated = np.arange(ts.size) % 30 != 15
+    dLat = drLat.copy()
+    dLon = drLon.copy()
+    dLat[decimated] = np.nan
+    dLon[decimated] = np.nan
+    cache = {}
+    uv = depthAveragedCurrents(ts, depth, gpsLat, gpsLon, dLat, dLon,
+        profileTimes,
+        cache=cache)
+    assert len(cache) == 0
+    assert np.all(np.isnan(uv['u'])) and np.all(np.isnan(uv['v']))
+
+    # ...until the full resolution data is available
+    uv = depthAveragedCurrents(ts, depth, gpsLat, gpsLon, drLat, drLon,
+        profileTimes,
+        cache=cache)
+    assert len(cache) == 2
+    assert np.allclose(uv['u'][inDive], U, rtol=0.01)
+    assert np.allclose(uv['v'][inDive], V, rtol=0.01)
+
+    # Scalar profile time
+    uv = depthAveragedCurrents(ts, depth, gpsLat, gpsLon, drLat, drLon, ts[50])
+    assert uv['u'].shape == (1,)
+
+
+if __name__ == '__main__':
+    _selfCheck()
+    print('depthAveragedCurrents: self-check passed')